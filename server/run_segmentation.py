@@ -1,60 +1,185 @@
 import argparse
 import base64
 import json
+import os
+import socket
+import subprocess
+import sys
+import time
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
 
-from segmentation import segment_image, segment_image_sam2
+try:
+    import orjson
+except ImportError:  # pragma: no cover - orjson è opzionale
+    orjson = None
+
+from segmentation_worker import DEFAULT_SOCKET_PATH, code_version, prepare_socket_dir, socket_owned
+
+WORKER_SCRIPT = Path(__file__).with_name("segmentation_worker.py")
+WORKER_START_TIMEOUT = float(os.getenv("SEGMENTATION_WORKER_START_TIMEOUT", "180"))
 
 
 def decode_json_b64(value: Optional[str]):
     if not value:
         return None
-    data = base64.b64decode(value.encode("utf-8")).decode("utf-8")
-    return json.loads(data)
+    data = base64.b64decode(value.encode("utf-8"))
+    if orjson is not None:
+        # orjson accetta direttamente i bytes, senza il passaggio da str
+        return orjson.loads(data)
+    return json.loads(data.decode("utf-8"))
+
+
+def _connect(socket_path: str) -> Optional[socket.socket]:
+    # Un socket di un altro utente riceverebbe i path delle immagini e potrebbe restituire maschere arbitrarie
+    if not socket_owned(socket_path):
+        return None
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except OSError:
+        conn.close()
+        return None
+    return conn
+
+
+def _start_worker(socket_path: str, algorithm: str, model_size: str) -> Optional[socket.socket]:
+    """Avvia il worker in background e attende che il socket sia pronto.
+
+    Lo stderr del worker (errori e precisione del modello caricato) finisce in ``<socket>.log``."""
+    try:
+        prepare_socket_dir(socket_path)
+    except (OSError, RuntimeError) as exc:
+        print(f"Worker di segmentazione non avviato: {exc}", file=sys.stderr)
+        return None
+    with open(socket_path + ".log", "ab") as log_file:
+        worker = subprocess.Popen(
+            [
+                sys.executable,
+                str(WORKER_SCRIPT),
+                "--socket",
+                socket_path,
+                "--algorithm",
+                algorithm,
+                "--model-size",
+                model_size,
+            ],
+            cwd=str(WORKER_SCRIPT.parent),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=log_file,
+            start_new_session=True,
+        )
+    deadline = time.monotonic() + WORKER_START_TIMEOUT
+    while time.monotonic() < deadline:
+        conn = _connect(socket_path)
+        if conn is not None:
+            return conn
+        if worker.poll() is not None:
+            # Il worker è terminato (es. un altro worker ha vinto la corsa al socket)
+            return _connect(socket_path)
+        time.sleep(0.1)
+    return None
+
+
+def request_worker(conn: socket.socket, request: dict) -> Optional[List[bytes]]:
+    """Invia la richiesta al worker; ``None`` se è obsoleto, disconnesso o la risposta è troncata."""
+    try:
+        with conn, conn.makefile("rb") as stream:
+            conn.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            line = stream.readline()
+            if not line:
+                return None
+            header = json.loads(line)
+            if header.get("stale"):
+                return None
+            if not header.get("ok"):
+                raise SystemExit(header.get("error") or "Errore nel worker di segmentazione")
+            masks = []
+            for size in header["sizes"]:
+                chunk = stream.read(size)
+                if len(chunk) != size:
+                    # Risposta troncata (worker terminato a metà invio): si ripiega sul processo locale
+                    return None
+                masks.append(chunk)
+            return masks
+    except OSError:
+        return None
+
+
+def segment_in_process(request: dict) -> List[bytes]:
+    from segmentation_worker import handle_request
+
+    return handle_request(request)
 
 
 def main() -> None:
     parser = argparse.ArgumentParser(description="Runner CLI per SAM/SAM2 (ultralytics)")
     parser.add_argument("--image", required=True, help="Path immagine di input")
-    parser.add_argument("--output", required=True, help="Path dove salvare il PNG risultante")
+    parser.add_argument(
+        "--output",
+        required=True,
+        action="append",
+        help="Path dove salvare il PNG risultante (ripetuto, uno per prompt, con --prompts-b64)",
+    )
     parser.add_argument("--algorithm", choices=["sam", "sam2"], default="sam2")
     parser.add_argument("--model-size", default="base")
     parser.add_argument("--prompt-type", choices=["point", "box"], default="point")
     parser.add_argument("--points-b64", default=None)
     parser.add_argument("--labels-b64", default=None)
     parser.add_argument("--bbox-b64", default=None)
+    parser.add_argument(
+        "--prompts-b64",
+        default=None,
+        help="Lista JSON di prompt {prompt_type, points, labels, bbox}: una maschera per prompt",
+    )
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="Path del socket del worker")
+    parser.add_argument(
+        "--no-worker",
+        action="store_true",
+        help="Esegue la segmentazione in questo processo senza usare il worker",
+    )
     args = parser.parse_args()
 
-    image_bytes = Path(args.image).read_bytes()
-    points = decode_json_b64(args.points_b64)
-    labels = decode_json_b64(args.labels_b64)
-    bbox = decode_json_b64(args.bbox_b64)
-
-    if args.prompt_type == "box" and bbox is None:
-        raise SystemExit("Per prompt box devi fornire il bbox")
-
-    if args.algorithm == "sam2":
-        mask_bytes = segment_image_sam2(
-            image_bytes,
-            points,
-            labels=labels,
-            model_size=args.model_size,
-            prompt_type=args.prompt_type,
-            bbox=bbox,
-        )
+    request = {
+        "version": code_version(),
+        "image_path": str(Path(args.image).resolve()),
+        "algorithm": args.algorithm,
+        "model_size": args.model_size,
+        "prompt_type": args.prompt_type,
+        "points": decode_json_b64(args.points_b64),
+        "labels": decode_json_b64(args.labels_b64),
+        "bbox": decode_json_b64(args.bbox_b64),
+    }
+
+    prompts = decode_json_b64(args.prompts_b64)
+    if prompts is not None:
+        request["prompts"] = prompts
+        if len(args.output) != len(prompts):
+            raise SystemExit("Serve un --output per ogni prompt")
     else:
-        mask_bytes = segment_image(
-            image_bytes,
-            points,
-            labels=labels,
-            model_size=args.model_size,
-            prompt_type=args.prompt_type,
-            bbox=bbox,
-        )
+        if len(args.output) != 1:
+            raise SystemExit("Senza --prompts-b64 è previsto un solo --output")
+        if args.prompt_type == "box" and request["bbox"] is None:
+            raise SystemExit("Per prompt box devi fornire il bbox")
+
+    masks = None
+    if not args.no_worker:
+        conn = _connect(args.socket)
+        if conn is not None:
+            masks = request_worker(conn, request)
+        if masks is None:
+            # Nessun worker attivo, oppure obsoleto e già terminato: se ne avvia uno nuovo
+            conn = _start_worker(args.socket, args.algorithm, args.model_size)
+            if conn is not None:
+                masks = request_worker(conn, request)
+
+    if masks is None:
+        masks = segment_in_process(request)
 
-    Path(args.output).parent.mkdir(parents=True, exist_ok=True)
-    Path(args.output).write_bytes(mask_bytes)
+    for output, mask_bytes in zip(args.output, masks):
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+        Path(output).write_bytes(mask_bytes)
 
 
 if __name__ == "__main__":
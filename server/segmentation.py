@@ -3,8 +3,13 @@
 Basato sul frammento fornito dall'utente, con piccoli adattamenti
 (per esempio supporto opzionale alle label 0/1 per i punti)."""
 
+import contextlib
+import io
+import logging
 import os
-from typing import Dict, List, Optional
+import threading
+import types
+from typing import BinaryIO, Dict, List, Mapping, Optional, Tuple, Union
 
 import cv2
 import numpy as np
@@ -14,6 +19,30 @@ try:
 except ImportError:  # pragma: no cover - rende l'errore più leggibile a runtime
     UltralyticsSAM = None
 
+try:
+    import torch
+except ImportError:  # pragma: no cover - torch arriva come dipendenza di ultralytics
+    torch = None
+
+
+# Rilevato una sola volta: su CUDA usiamo la prima GPU in FP16, altrimenti CPU in FP32.
+# L'FP16 passa da torch.autocast e non dall'argomento ``half`` di predict: il predictor SAM lo
+# ignora in buona parte delle release 8.3 e le più recenti leggono invece ``quantize``.
+CUDA_AVAILABLE = torch is not None and torch.cuda.is_available()
+PREDICT_DEVICE = 0 if CUDA_AVAILABLE else "cpu"
+PREDICT_AUTOCAST_DTYPE = torch.float16 if CUDA_AVAILABLE else None
+PREDICT_IMGSZ = 1024
+
+# SAM riduce comunque l'input a 1024px: con SEGMENTATION_REDUCED_DECODE=1 i JPEG con lato corto da qui
+# in su vengono decodificati a metà risoluzione. Anche il ritaglio restituito è a metà risoluzione,
+# per questo è disattivato di default (le maschere salvate nel dataset restano a piena risoluzione).
+REDUCED_DECODE = os.getenv("SEGMENTATION_REDUCED_DECODE", "0") == "1"
+REDUCED_DECODE_MIN_SIDE = 2048
+
+ImageInput = Union[bytes, str, os.PathLike, np.ndarray]
+
+# Buffer di lavoro per thread, riusato tra le richieste del worker invece di allocare pagine nuove
+_scratch = threading.local()
 
 VALID_MODEL_SIZES = ("tiny", "small", "base", "large")
 
@@ -31,19 +60,35 @@ SAM2_MODEL_FILES: Dict[str, str] = {
     "large": os.getenv("SAM2_MODEL_LARGE_PATH", "sam2_l.pt"),
 }
 
+# Lookup unica (algoritmo, dimensione) -> pesi, risolta una volta all'import
+_WEIGHTS: Mapping[Tuple[str, str], str] = types.MappingProxyType(
+    {
+        **{("sam", size): weights for size, weights in SAM_MODEL_FILES.items()},
+        **{("sam2", size): weights for size, weights in SAM2_MODEL_FILES.items()},
+    }
+)
+
 _model_cache: Dict[str, UltralyticsSAM] = {}
 
+logger = logging.getLogger(__name__)
+
+
+def _warn_missing_weights() -> None:
+    # I nomi senza cartella (es. "sam_b.pt") vengono scaricati da ultralytics: si controllano solo i path configurati
+    for (algorithm, size), weights in _WEIGHTS.items():
+        if weights and os.path.dirname(weights) and not os.path.exists(weights):
+            logger.warning("Pesi %s:%s non trovati in %s", algorithm, size, weights)
+
+
+_warn_missing_weights()
+
 
 def _resolve_weights(algorithm: str, size: str) -> str:
     size = size.lower()
-    if size not in VALID_MODEL_SIZES:
-        raise ValueError(f"Dimensione modello non supportata: {size}")
-
-    if algorithm == "sam":
-        weights = SAM_MODEL_FILES[size]
-    elif algorithm == "sam2":
-        weights = SAM2_MODEL_FILES[size]
-    else:
+    weights = _WEIGHTS.get((algorithm, size))
+    if weights is None:
+        if size not in VALID_MODEL_SIZES:
+            raise ValueError(f"Dimensione modello non supportata: {size}")
         raise ValueError(f"Algoritmo di segmentazione non supportato: {algorithm}")
 
     if not weights:
@@ -66,70 +111,169 @@ def _load_model(algorithm: str, size: str):
     return model
 
 
-def _segment_with_model(
-    model,
-    image_bytes: bytes,
-    *,
-    points: Optional[List[List[float]]] = None,
-    labels: Optional[List[int]] = None,
-    bbox: Optional[List[float]] = None,
-    prompt_type: str = "point",
-) -> bytes:
-    nparr = np.frombuffer(image_bytes, np.uint8)
-    img = cv2.imdecode(nparr, cv2.IMREAD_COLOR)
+def _predict(model, img: np.ndarray, **prompts):
+    """Esegue ``model.predict`` sul device scelto, senza tracciamento autograd."""
+    with contextlib.ExitStack() as stack:
+        if torch is not None:
+            stack.enter_context(torch.inference_mode())
+        if PREDICT_AUTOCAST_DTYPE is not None:
+            stack.enter_context(torch.autocast("cuda", dtype=PREDICT_AUTOCAST_DTYPE))
+        return model.predict(img, device=PREDICT_DEVICE, imgsz=PREDICT_IMGSZ, **prompts)
+
+
+def describe_precision(model) -> str:
+    """Riassume device e precisione effettivi, per rendere visibile un eventuale ripiego su FP32."""
+    weights = next(model.model.parameters()).dtype if torch is not None else None
+    autocast = PREDICT_AUTOCAST_DTYPE or "disattivato"
+    return f"device={PREDICT_DEVICE}, pesi={weights}, autocast={autocast}"
+
+
+def _jpeg_size(stream: BinaryIO) -> Optional[Tuple[int, int]]:
+    """Legge ``(larghezza, altezza)`` dal marker SOF di un JPEG senza decodificarlo."""
+    if stream.read(2) != b"\xff\xd8":
+        return None
+    while True:
+        byte = stream.read(1)
+        while byte and byte != b"\xff":
+            byte = stream.read(1)
+        while byte == b"\xff":
+            byte = stream.read(1)
+        if not byte:
+            return None
+        marker = byte[0]
+        if marker == 0x01 or 0xD0 <= marker <= 0xD8:
+            continue  # marker senza payload
+        length_bytes = stream.read(2)
+        if len(length_bytes) != 2:
+            return None
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            sof = stream.read(5)
+            if len(sof) != 5:
+                return None
+            return int.from_bytes(sof[3:5], "big"), int.from_bytes(sof[1:3], "big")
+        stream.seek(int.from_bytes(length_bytes, "big") - 2, io.SEEK_CUR)
+
+
+def _decode_flags(stream: BinaryIO) -> Tuple[int, float]:
+    size = _jpeg_size(stream)
+    if size is not None and min(size) >= REDUCED_DECODE_MIN_SIDE:
+        # Decodifica DCT a 1/2 di libjpeg: circa 4 volte meno lavoro
+        return cv2.IMREAD_REDUCED_COLOR_2, 0.5
+    return cv2.IMREAD_COLOR, 1.0
+
+
+def _decode_image(image: ImageInput) -> Tuple[np.ndarray, float]:
+    """Restituisce l'immagine BGR e il fattore di scala rispetto all'originale."""
+    if isinstance(image, np.ndarray):
+        return image, 1.0
+    flags, scale = cv2.IMREAD_COLOR, 1.0
+    if isinstance(image, (str, os.PathLike)):
+        if REDUCED_DECODE:
+            with open(image, "rb") as stream:
+                flags, scale = _decode_flags(stream)
+        img = cv2.imread(os.fspath(image), flags)
+    else:
+        if REDUCED_DECODE:
+            flags, scale = _decode_flags(io.BytesIO(image))
+        img = cv2.imdecode(np.frombuffer(image, np.uint8), flags)
     if img is None:
         raise ValueError("Immagine non valida o formato non supportato.")
-
-    h, w = img.shape[:2]
-
-    if prompt_type == "box":
-        if bbox is None:
-            raise ValueError("Devi fornire un bounding box per la modalità box.")
-        bbox_arr = np.asarray(bbox, dtype=np.float32).reshape(-1)
-        if bbox_arr.size != 4:
-            raise ValueError("Il bounding box deve contenere 4 valori [x1, y1, x2, y2].")
-        x1, y1, x2, y2 = bbox_arr
-        x1, x2 = np.clip([x1, x2], 0, w - 1)
-        y1, y2 = np.clip([y1, y2], 0, h - 1)
-        x_min, x_max = (x1, x2) if x1 <= x2 else (x2, x1)
-        y_min, y_max = (y1, y2) if y1 <= y2 else (y2, y1)
-        if abs(x_max - x_min) < 1 or abs(y_max - y_min) < 1:
-            raise ValueError("Il bounding box è troppo piccolo.")
-        bbox_arr = np.array([x_min, y_min, x_max, y_max], dtype=np.float32)
-        results = model.predict(img, bboxes=[bbox_arr.tolist()])
+    return img, scale
+
+
+def _scratch_array(shape: Tuple[int, ...]) -> np.ndarray:
+    """Vista uint8 di forma ``shape`` sul buffer del thread, ingrandito solo quando serve."""
+    size = int(np.prod(shape))
+    buffer = getattr(_scratch, "buffer", None)
+    if buffer is None or buffer.size < size:
+        buffer = np.empty(size, dtype=np.uint8)
+        _scratch.buffer = buffer
+    return buffer[:size].reshape(shape)
+
+
+def _prepare_box(bbox: Optional[List[float]], scale: float, w: int, h: int) -> List[float]:
+    if bbox is None:
+        raise ValueError("Devi fornire un bounding box per la modalità box.")
+    if len(bbox) != 4:
+        raise ValueError("Il bounding box deve contenere 4 valori [x1, y1, x2, y2].")
+    x1, y1, x2, y2 = (float(value) * scale for value in bbox)
+    x_min, x_max = sorted((min(max(x1, 0.0), w - 1), min(max(x2, 0.0), w - 1)))
+    y_min, y_max = sorted((min(max(y1, 0.0), h - 1), min(max(y2, 0.0), h - 1)))
+    if x_max - x_min < 1 or y_max - y_min < 1:
+        raise ValueError("Il bounding box è troppo piccolo.")
+    return [x_min, y_min, x_max, y_max]
+
+
+def _prepare_points(
+    points: Optional[List[List[float]]], labels: Optional[List[int]], scale: float, w: int, h: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    if not points:
+        raise ValueError("Devi fornire almeno un punto per la segmentazione.")
+    points_arr = np.asarray(points, dtype=np.float32)
+    if points_arr.ndim != 2 or points_arr.shape[1] != 2:
+        raise ValueError("Ogni punto deve essere nella forma [x, y].")
+    if scale != 1.0:
+        points_arr *= scale
+    if labels is not None:
+        label_arr = np.asarray(labels, dtype=np.int32).reshape(-1)
+        if label_arr.size != len(points_arr):
+            raise ValueError("Il numero di label non corrisponde ai punti.")
     else:
-        if not points:
-            raise ValueError("Devi fornire almeno un punto per la segmentazione.")
-        points_arr = np.asarray(points, dtype=np.float32)
-        if points_arr.ndim != 2 or points_arr.shape[1] != 2:
-            raise ValueError("Ogni punto deve essere nella forma [x, y].")
-        if labels is not None:
-            label_arr = np.asarray(labels, dtype=np.int32).reshape(-1)
-            if label_arr.size != len(points_arr):
-                raise ValueError("Il numero di label non corrisponde ai punti.")
-        else:
-            label_arr = np.ones(len(points_arr), dtype=np.int32)
-        label_arr = np.clip(label_arr, 0, 1).astype(int)
-        results = model.predict(img, points=points_arr.tolist(), labels=label_arr.tolist())
-
-    if not results or not getattr(results[0], "masks", None):
-        raise ValueError("La segmentazione non ha prodotto risultati.")
-
-    mask_tensor = results[0].masks.data[0]
-    mask = mask_tensor.cpu().numpy() if hasattr(mask_tensor, "cpu") else np.asarray(mask_tensor)
-    mask = (mask > 0.5).astype(np.uint8)  # 0/1
-
+        label_arr = np.ones(len(points_arr), dtype=np.int32)
+
+    # Scarta i punti fuori dall'immagine e i duplicati sullo stesso pixel (vince il primo)
+    pixels = np.floor(points_arr).astype(np.int32)
+    inside = (pixels[:, 0] >= 0) & (pixels[:, 0] < w) & (pixels[:, 1] >= 0) & (pixels[:, 1] < h)
+    if not inside.any():
+        raise ValueError("Nessun punto cade all'interno dell'immagine.")
+    points_arr, label_arr, pixels = points_arr[inside], label_arr[inside], pixels[inside]
+    _, first = np.unique(pixels, axis=0, return_index=True)
+    keep = np.sort(first)
+    return points_arr[keep], np.clip(label_arr[keep], 0, 1)
+
+
+def _stack_points(prompts: List[Tuple[np.ndarray, np.ndarray]]) -> Tuple[np.ndarray, np.ndarray]:
+    """Impila K prompt a punti in ``(K, N, 2)``; i punti di riempimento hanno label -1 (ignorati da SAM).
+
+    I punti 3-D richiedono ultralytics >= 8.3.12 (vedi requirements.txt)."""
+    max_points = max(len(points_arr) for points_arr, _ in prompts)
+    stacked_points = np.zeros((len(prompts), max_points, 2), dtype=np.float32)
+    stacked_labels = np.full((len(prompts), max_points), -1, dtype=np.int32)
+    for index, (points_arr, label_arr) in enumerate(prompts):
+        stacked_points[index, : len(points_arr)] = points_arr
+        stacked_labels[index, : len(label_arr)] = label_arr
+    return stacked_points, stacked_labels
+
+
+def _mask_to_numpy(mask_tensor, h: int, w: int) -> np.ndarray:
+    if torch is not None and isinstance(mask_tensor, torch.Tensor):
+        if tuple(mask_tensor.shape[-2:]) != (h, w):
+            # Maschera a risoluzione ridotta: upsampling sul device, prima della soglia
+            mask_tensor = torch.nn.functional.interpolate(
+                mask_tensor.float()[None, None], size=(h, w), mode="bilinear", align_corners=False
+            )[0, 0]
+        # Soglia sul device: si scarica 1 byte per pixel invece di un float32
+        return (mask_tensor > 0.5).to(torch.uint8).cpu().numpy()  # 0/1
+    return (np.asarray(mask_tensor) > 0.5).astype(np.uint8)  # 0/1
+
+
+def _encode_masked_crop(img: np.ndarray, mask: np.ndarray) -> bytes:
+    if cv2.countNonZero(mask) == 0:
+        raise ValueError("La segmentazione ha prodotto una maschera vuota.")
+
+    # Crop sul bounding box della maschera prima di applicarla: si lavora solo sui pixel del ritaglio
+    x, y, w_box, h_box = cv2.boundingRect(mask)
+    sub_mask = mask[y : y + h_box, x : x + w_box]
     # Usa direttamente l'immagine originale in BGR
-    masked = img.copy()
+    crop = img[y : y + h_box, x : x + w_box]
 
-    # Metti a nero tutto ciò che NON è nella maschera
-    masked[mask == 0] = [0, 0, 0]
+    # Copia solo i pixel nella maschera: il resto rimane nero
+    cropped = _scratch_array(crop.shape)
+    cropped.fill(0)
+    cv2.copyTo(crop, sub_mask, cropped)
 
-    # Crop sul bounding box della maschera
-    x, y, w_box, h_box = cv2.boundingRect(mask)
-    cropped = masked if w_box == 0 or h_box == 0 else masked[y : y + h_box, x : x + w_box]
-
-    # Encode PNG (OpenCV si aspetta BGR: siamo a posto)
+    # Encode PNG (OpenCV si aspetta BGR: siamo a posto). Senza parametri usa già zlib livello 1 con
+    # strategia RLE, adatta alle maschere quasi tutte nere: un IMWRITE_PNG_COMPRESSION esplicito è più lento
     success, buffer = cv2.imencode(".png", cropped)
     if not success:
         raise RuntimeError("Impossibile codificare l'immagine segmentata.")
@@ -137,8 +281,73 @@ def _segment_with_model(
     return buffer.tobytes()
 
 
+def _segment_prompts(model, image: ImageInput, prompts: List[Dict]) -> List[bytes]:
+    """Segmenta più prompt sulla stessa immagine.
+
+    I prompt dello stesso tipo vanno in un'unica ``predict``: l'encoder
+    dell'immagine gira una volta sola e solo il decoder lavora per prompt.
+    Con SAM2 anche box e punti misti condividono la stessa ``predict``: i box
+    diventano coppie di angoli con label 2/3, come fa ultralytics internamente."""
+    if not prompts:
+        raise ValueError("Devi fornire almeno un prompt per la segmentazione.")
+
+    img, scale = _decode_image(image)
+    h, w = img.shape[:2]
+
+    box_indices: List[int] = []
+    boxes: List[List[float]] = []
+    point_indices: List[int] = []
+    point_prompts: List[Tuple[np.ndarray, np.ndarray]] = []
+    for index, prompt in enumerate(prompts):
+        if prompt.get("prompt_type", "point") == "box":
+            box_indices.append(index)
+            boxes.append(_prepare_box(prompt.get("bbox"), scale, w, h))
+        else:
+            point_indices.append(index)
+            point_prompts.append(_prepare_points(prompt.get("points"), prompt.get("labels"), scale, w, h))
+
+    if boxes and point_prompts and getattr(model, "is_sam2", False):
+        for index, (x_min, y_min, x_max, y_max) in zip(box_indices, boxes):
+            point_indices.append(index)
+            corners = np.array([[x_min, y_min], [x_max, y_max]], dtype=np.float32)
+            point_prompts.append((corners, np.array([2, 3], dtype=np.int32)))
+        box_indices, boxes = [], []
+
+    batches = []
+    if boxes:
+        batches.append((box_indices, {"bboxes": boxes}))
+    if point_prompts:
+        stacked_points, stacked_labels = _stack_points(point_prompts)
+        # Ultralytics converte i prompt con torch.as_tensor: gli ndarray vanno bene così
+        batches.append((point_indices, {"points": stacked_points, "labels": stacked_labels}))
+
+    outputs: List[Optional[bytes]] = [None] * len(prompts)
+    for indices, prompt_kwargs in batches:
+        results = _predict(model, img, **prompt_kwargs)
+        if not results or not getattr(results[0], "masks", None) or len(results[0].masks.data) < len(indices):
+            raise ValueError("La segmentazione non ha prodotto risultati.")
+        masks = results[0].masks.data
+        for position, index in enumerate(indices):
+            outputs[index] = _encode_masked_crop(img, _mask_to_numpy(masks[position], h, w))
+
+    return outputs
+
+
+def _segment_with_model(
+    model,
+    image: ImageInput,
+    *,
+    points: Optional[List[List[float]]] = None,
+    labels: Optional[List[int]] = None,
+    bbox: Optional[List[float]] = None,
+    prompt_type: str = "point",
+) -> bytes:
+    prompt = {"prompt_type": prompt_type, "points": points, "labels": labels, "bbox": bbox}
+    return _segment_prompts(model, image, [prompt])[0]
+
+
 def segment_image(
-    image_bytes: bytes,
+    image: ImageInput,
     points: Optional[List[List[float]]],
     *,
     labels: Optional[List[int]] = None,
@@ -149,7 +358,7 @@ def segment_image(
     model = _load_model("sam", model_size)
     return _segment_with_model(
         model,
-        image_bytes,
+        image,
         points=points,
         labels=labels,
         prompt_type=prompt_type,
@@ -158,7 +367,7 @@ def segment_image(
 
 
 def segment_image_sam2(
-    image_bytes: bytes,
+    image: ImageInput,
     points: Optional[List[List[float]]],
     *,
     labels: Optional[List[int]] = None,
@@ -169,9 +378,21 @@ def segment_image_sam2(
     model = _load_model("sam2", model_size)
     return _segment_with_model(
         model,
-        image_bytes,
+        image,
         points=points,
         labels=labels,
         bbox=bbox,
         prompt_type=prompt_type,
     )
+
+
+def segment_image_multi(
+    image: ImageInput,
+    prompts: List[Dict],
+    *,
+    algorithm: str = "sam2",
+    model_size: str = "base",
+) -> List[bytes]:
+    """Una maschera per ogni prompt ``{prompt_type, points, labels, bbox}``, nello stesso ordine."""
+    model = _load_model(algorithm, model_size)
+    return _segment_prompts(model, image, prompts)
@@ -0,0 +1,237 @@
+"""Worker persistente per SAM/SAM2.
+
+Tiene i modelli caricati in memoria (``_model_cache`` di ``segmentation``) e
+serve le richieste del runner CLI su un socket UNIX, evitando di ricaricare i
+pesi e reinizializzare CUDA a ogni segmentazione.
+
+Protocollo: il client invia una riga JSON
+``{version, image_path, algorithm, model_size, prompt_type, points, labels, bbox}``
+oppure, per più maschere sulla stessa immagine, ``prompts`` con una lista di
+``{prompt_type, points, labels, bbox}``; il worker risponde con una riga JSON
+``{"ok": true, "sizes": [N1, N2, ...]}`` seguita dai PNG concatenati, uno per
+prompt, oppure ``{"ok": false, "error": "..."}``.
+
+Il worker termina da solo dopo ``SEGMENTATION_WORKER_IDLE_TIMEOUT`` secondi
+senza richieste, quando riceve ``{"command": "shutdown"}`` (``--stop``) o
+quando un client segnala una ``version`` diversa, cioè il codice Python è
+stato modificato dopo l'avvio: in quel caso risponde ``"stale": true`` e il
+client ne avvia uno nuovo."""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import socket
+import stat
+import tempfile
+from pathlib import Path
+from typing import List, Optional
+
+# Cartella privata dell'utente: nella tmp condivisa un altro utente potrebbe occupare il socket
+SOCKET_DIR = os.getenv("XDG_RUNTIME_DIR") or os.path.join(
+    tempfile.gettempdir(), f"tire-segmentation-{os.getuid()}"
+)
+# Un socket per checkout: copie diverse del progetto non si scambiano (né si chiudono) il worker
+_CHECKOUT_ID = hashlib.sha1(str(Path(__file__).resolve().parent).encode("utf-8")).hexdigest()[:12]
+DEFAULT_SOCKET_PATH = os.getenv(
+    "SEGMENTATION_WORKER_SOCKET",
+    os.path.join(SOCKET_DIR, f"tire-segmentation-{_CHECKOUT_ID}.sock"),
+)
+IDLE_TIMEOUT = float(os.getenv("SEGMENTATION_WORKER_IDLE_TIMEOUT", "900"))
+# Limite per leggere la richiesta e inviare la risposta: un client bloccato non ferma il worker
+CLIENT_TIMEOUT = 60.0
+
+logger = logging.getLogger("segmentation_worker")
+
+_CODE_FILES = (Path(__file__).with_name("segmentation.py"), Path(__file__))
+
+
+def code_version() -> str:
+    """Impronta dei sorgenti serviti dal worker (mtime), per riconoscere un worker obsoleto."""
+    return str(max(path.stat().st_mtime_ns for path in _CODE_FILES))
+
+
+def send_response(
+    conn: socket.socket,
+    payloads: Optional[List[bytes]] = None,
+    error: Optional[str] = None,
+    stale: bool = False,
+) -> None:
+    if error is not None:
+        header = {"ok": False, "error": error, "stale": stale}
+    else:
+        header = {"ok": True, "sizes": [len(payload) for payload in payloads or []]}
+    conn.sendall(json.dumps(header).encode("utf-8") + b"\n")
+    for payload in payloads or []:
+        conn.sendall(payload)
+
+
+def request_prompts(request: dict) -> List[dict]:
+    prompts = request.get("prompts")
+    if prompts is not None:
+        return prompts
+    return [
+        {
+            "prompt_type": request.get("prompt_type", "point"),
+            "points": request.get("points"),
+            "labels": request.get("labels"),
+            "bbox": request.get("bbox"),
+        }
+    ]
+
+
+def handle_request(request: dict) -> List[bytes]:
+    from segmentation import segment_image_multi
+
+    # Il path viene letto e decodificato da OpenCV, senza passare da un buffer di bytes;
+    # tutti i prompt passano da un'unica codifica dell'immagine
+    return segment_image_multi(
+        request["image_path"],
+        request_prompts(request),
+        algorithm=request.get("algorithm", "sam2"),
+        model_size=request.get("model_size", "base"),
+    )
+
+
+def prepare_socket_dir(socket_path: str) -> None:
+    """Crea la cartella di default del socket (0700) e verifica che appartenga solo all'utente."""
+    directory = os.path.dirname(os.path.abspath(socket_path))
+    if directory != os.path.abspath(SOCKET_DIR):
+        return  # path scelto con SEGMENTATION_WORKER_SOCKET o --socket
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    info = os.lstat(directory)
+    if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or info.st_mode & 0o077:
+        raise RuntimeError(f"La cartella {directory} non è privata dell'utente corrente")
+
+
+def socket_owned(path: str) -> bool:
+    """True se il socket esiste ed è stato creato dall'utente corrente."""
+    try:
+        return os.stat(path).st_uid == os.getuid()
+    except OSError:
+        return False
+
+
+def _socket_in_use(path: str) -> bool:
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        return False
+    finally:
+        probe.close()
+    return True
+
+
+def _unlink_if_owned(socket_path: str, inode: int) -> None:
+    # Un worker più recente può aver già creato un nuovo socket sullo stesso path: non va rimosso
+    try:
+        if os.stat(socket_path).st_ino == inode:
+            os.unlink(socket_path)
+    except FileNotFoundError:
+        pass
+
+
+def _serve_connection(conn: socket.socket, version: str, socket_path: str, inode: int) -> bool:
+    """Gestisce una richiesta; restituisce False quando il worker deve terminare."""
+    conn.settimeout(CLIENT_TIMEOUT)
+    with conn, conn.makefile("rb") as stream:
+        line = stream.readline()
+        if not line:
+            return True
+        try:
+            request = json.loads(line)
+            if request.get("command") == "shutdown":
+                _unlink_if_owned(socket_path, inode)
+                send_response(conn, [])
+                return False
+            if request.get("version", version) != version:
+                # Sorgenti modificati dopo l'avvio: si libera il socket prima di rispondere
+                _unlink_if_owned(socket_path, inode)
+                send_response(conn, error="Worker di segmentazione obsoleto", stale=True)
+                return False
+            masks = handle_request(request)
+        except Exception as exc:  # noqa: BLE001 - l'errore va restituito al client
+            send_response(conn, error=str(exc) or exc.__class__.__name__)
+        else:
+            send_response(conn, masks)
+    return True
+
+
+def serve(socket_path: str, algorithm: str, model_size: str) -> None:
+    from segmentation import _load_model, describe_precision
+
+    version = code_version()
+
+    prepare_socket_dir(socket_path)
+    if os.path.exists(socket_path):
+        if _socket_in_use(socket_path):
+            raise SystemExit(f"Un worker è già in ascolto su {socket_path}")
+        os.unlink(socket_path)
+
+    # Caricamento eager: il primo client non paga il costo dei pesi
+    model = _load_model(algorithm, model_size)
+    logger.info("Modello %s:%s caricato (%s)", algorithm, model_size, describe_precision(model))
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(socket_path)
+    inode = os.stat(socket_path).st_ino
+    server.listen()
+    if IDLE_TIMEOUT > 0:
+        server.settimeout(IDLE_TIMEOUT)
+    try:
+        running = True
+        while running:
+            try:
+                conn, _ = server.accept()
+            except socket.timeout:
+                break  # inattivo troppo a lungo: libera GPU e memoria
+            try:
+                running = _serve_connection(conn, version, socket_path, inode)
+            except OSError:
+                # Client disconnesso o bloccato a metà richiesta: si passa al successivo
+                continue
+    finally:
+        server.close()
+        _unlink_if_owned(socket_path, inode)
+
+
+def stop(socket_path: str) -> bool:
+    if not socket_owned(socket_path):
+        return False
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        conn.connect(socket_path)
+    except OSError:
+        conn.close()
+        return False
+    with conn, conn.makefile("rb") as stream:
+        conn.sendall(json.dumps({"command": "shutdown"}).encode("utf-8") + b"\n")
+        stream.readline()
+    return True
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Worker persistente per SAM/SAM2 (ultralytics)")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET_PATH, help="Path del socket UNIX")
+    parser.add_argument(
+        "--algorithm",
+        choices=["sam", "sam2"],
+        default=os.getenv("SEGMENTATION_DEFAULT_ALGORITHM", "sam2"),
+    )
+    parser.add_argument("--model-size", default=os.getenv("SEGMENTATION_DEFAULT_MODEL_SIZE", "base"))
+    parser.add_argument("--stop", action="store_true", help="Arresta il worker in ascolto sul socket")
+    args = parser.parse_args()
+
+    if args.stop:
+        if not stop(args.socket):
+            raise SystemExit(f"Nessun worker dell'utente corrente in ascolto su {args.socket}")
+        return
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(message)s")
+    serve(args.socket, args.algorithm, args.model_size)
+
+
+if __name__ == "__main__":
+    main()